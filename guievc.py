@@ -38,6 +38,12 @@ import threading
 
 evap = libevc.EvapParams('EVC')
 data = libevc.Data()
+# samples for plotter/logger processes, attach with SampleBus(create=False)
+try:
+    bus = libevc.SampleBus()
+except RuntimeError as err_msg:
+    print('Samples not published: {}'.format(err_msg))
+    bus = None
 
 
 class EnterSelectElement(wx.Panel):
@@ -186,6 +192,7 @@ class EvapGUI(wx.Frame):
         self.redraw_timer = wx.Timer(self)
         self.Bind(wx.EVT_TIMER, self.on_redraw_timer, self.redraw_timer)
         self.redraw_timer.Start(self.redrawtime*1000)
+        self.Bind(wx.EVT_CLOSE, self.on_exit)
 
     def create_main_panel(self):
         '''Creates main panel with all the GUI elements. A lot of box sizers
@@ -404,8 +411,11 @@ class EvapGUI(wx.Frame):
         self.canvas_emis.draw()
 
     def on_pause_button(self, event):
-        '''Sets paused to false/true.'''
+        '''Sets paused to false/true. Resuming searches the EVC on all ports
+        if it is not connected.'''
         self.paused = not self.paused
+        if not self.paused:
+            evap.controller.rescan()
 
     def on_update_pause_button(self, event):
         '''Updates the label on the pause button.'''
@@ -444,7 +454,13 @@ class EvapGUI(wx.Frame):
         # if paused do not add data, but still redraw the plot
         # (to respond to scale modifications, grid change, etc.)
         if not self.paused:
-            evap.update_params()
+            if not evap.update_params():
+                # keep data and plot while the EVC reconnects or a value
+                # is missing
+                self.set_textboxlabels('--', '--', '--', '--', '--')
+                return
+            if bus is not None:
+                bus.publish(evap)
             data.add_val(evap.flux, evap.emis)
             self.draw_plot_flux()
             self.draw_plot_emis()
@@ -453,6 +469,9 @@ class EvapGUI(wx.Frame):
 
     def on_exit(self, event):
         '''Destroys the application when you close it.'''
+        self.redraw_timer.Stop()
+        if bus is not None:
+            bus.close(unlink=True)
         self.Destroy()
 
 if __name__ == '__main__':
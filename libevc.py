@@ -20,9 +20,20 @@
 
 from __future__ import print_function
 from __future__ import division
+import fcntl
+import mmap
+import os
 import serial
+from serial.tools import list_ports
+import struct
+import termios
+import threading
 import time
 
+# errors of a serial port whose device is gone (termios.error and IOError
+# are no OSError in Python 2)
+SERIAL_ERRORS = (serial.SerialException, EnvironmentError, termios.error)
+
 
 class EvapParams():
     '''EVCstate contains the state of all EVC / evaporator parameters like
@@ -46,12 +57,20 @@ class EvapParams():
             self.controller = EVC()
 
     def update_params(self):
-        '''Returns all evaporator parameters.'''
+        '''Reads all evaporator parameters. Returns False if the controller
+        is not connected or a value could not be read (those parameters are
+        None then).'''
+        if not self.controller.connected:
+            self.controller.reconnect()
+            self.fil = self.emis = self.flux = self.temp = self.hv = None
+            return False
         self.fil = self.get_fil()
         self.emis = self.get_emis()
         self.flux = self.get_flux()
         self.temp = self.get_temp()
         self.hv = self.get_hv()
+        return None not in (self.fil, self.emis, self.flux, self.temp,
+                            self.hv)
 
     def print_status(self):
         ''' Print evaporator parameters to stdout.'''
@@ -99,7 +118,10 @@ class EvapParams():
 
     def get_flux(self):
         '''Reads flux.'''
-        return self.controller.get_value('Flux')*10**9
+        flux = self.controller.get_value('Flux')
+        if flux is None:
+            return None
+        return flux*10**9
 
     def get_hv(self):
         '''Reads volt.'''
@@ -128,34 +150,227 @@ class EvapParams():
 
 class EVC():
     '''Class to communicate with EVC300 controller.'''
-    def __init__(self):
-        '''Initializes the communication with the EVC300.'''
+    # (vid, pid) of the USB-serial adapters probed in a full scan,
+    # None probes every USB-serial port
+    usb_ids = None
+    # plausible ranges of the parameters read to identify the EVC300
+    ident_ranges = {'Fil': (0, 10), 'Emis': (0, 100), 'HV': (0, 1200),
+                    'Temp': (-50, 3000)}
+    probe_timeout = 0.3  # sec
+    backoff_min = 0.1  # sec
+    backoff_max = 1.0  # sec
+    max_parse_errors = 3
+
+    def __init__(self, port='/dev/ttyUSB0', ports=None):
+        '''Initializes the communication with the EVC300. port is probed
+        first, then ports (list of device names) or, if not given, all
+        USB-serial ports.'''
         # settings for EVC300
         # give permission to user to access port ttyUSB0 -> links.txt
         # BUG in EVC300: Emission control not remote available
+        self.port = port
+        self.ports = ports
+        self.ser = None
+        self.adapter = None  # (vid, pid, serial_number) of the EVC port
+        self.parse_errors = 0
+        self.full_scan = False
+        self.lock = threading.RLock()
+        self.probe_lock = threading.Lock()
+        self.reconnect_thread = None
+        self.discover(full=True)
+        if self.ser is None:
+            print('Not able to find EVC on any serial port')
+
+    @property
+    def connected(self):
+        '''True if a serial connection to the EVC300 is open.'''
+        return self.ser is not None
+
+    def port_id(self, info):
+        '''Returns the identity of a USB-serial port given by list_ports.'''
+        return (info.vid, info.pid, info.serial_number)
+
+    def candidate_ports(self, full=False):
+        '''Returns the serial ports to probe, last known port first. Only a
+        full scan probes other devices than the identified EVC adapter.'''
+        usb_ports = [info for info in list_ports.comports()
+                     if info.vid is not None]
+        if full:
+            if self.ports is not None:
+                ports = list(self.ports)
+            else:
+                ports = sorted(info.device for info in usb_ports
+                               if self.usb_ids is None or
+                               (info.vid, info.pid) in self.usb_ids)
+        elif self.adapter is not None:
+            # the adapter may have been re-enumerated under another name
+            ports = sorted(info.device for info in usb_ports
+                           if self.port_id(info) == self.adapter)
+        else:
+            ports = []
+        if self.port in ports:
+            ports.remove(self.port)
+        if full or self.adapter is None:
+            ports.insert(0, self.port)
+        return ports
+
+    def open_port(self, port, timeout=1):
+        '''Opens port exclusively with the settings of the EVC300. DTR is
+        not asserted to leave other devices untouched.'''
+        ser = serial.Serial(
+            baudrate=57600,
+            parity=serial.PARITY_NONE,
+            stopbits=serial.STOPBITS_ONE,
+            xonxoff=True,
+            bytesize=serial.EIGHTBITS,
+            timeout=timeout,
+            write_timeout=timeout,
+            exclusive=True)
+        ser.port = port
+        ser.dtr = False
+        ser.open()
+        return ser
+
+    def identify(self, ser):
+        '''Returns True if all parameters in ident_ranges are read from ser
+        as numbers within their plausible range.'''
+        for str_val, (minval, maxval) in self.ident_ranges.items():
+            ser.write('GET ' + str_val + '\r\n')
+            time.sleep(0.05)
+            try:
+                val = float(ser.read(ser.inWaiting()))
+            except ValueError:
+                return False
+            if not minval <= val <= maxval:
+                return False
+        return True
+
+    def probe_port(self, port, found, done):
+        '''Opens port and checks whether an EVC300 answers. On success the
+        open port is stored in found unless discover is already done.'''
+        try:
+            ser = self.open_port(port, self.probe_timeout)
+        except SERIAL_ERRORS + (ValueError,):
+            return
+        try:
+            ser.flushInput()
+            is_evc = self.identify(ser)
+        except SERIAL_ERRORS:
+            is_evc = False
+        with self.probe_lock:
+            if is_evc and not done.is_set():
+                ser.timeout = 1
+                ser.write_timeout = 1
+                found[port] = ser
+                return
         try:
-            self.ser = serial.Serial(
-                baudrate=57600,
-                port='/dev/ttyUSB0',
-                parity=serial.PARITY_NONE,
-                stopbits=serial.STOPBITS_ONE,
-                xonxoff=True,
-                bytesize=serial.EIGHTBITS,
-                timeout=1)
-            print('evap: Serial port to EVC open')
-        except serial.SerialException as err_msg:
-            print('Not able to open serial port: {}'.format(err_msg))
+            ser.close()
+        except SERIAL_ERRORS:
+            pass
+
+    def discover(self, full=False):
+        '''Probes the candidate ports in parallel and keeps the connection
+        to the first EVC300 found. Returns True on success.'''
+        ports = self.candidate_ports(full)
+        found = {}
+        done = threading.Event()
+        threads = [threading.Thread(target=self.probe_port,
+                                    args=[port, found, done])
+                   for port in ports]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join(len(self.ident_ranges)*self.probe_timeout + 1)
+        # probes finishing from now on close their port themselves
+        with self.probe_lock:
+            done.set()
+        for port in ports:
+            ser = found.pop(port, None)
+            if ser is None:
+                continue
+            if self.ser is None:
+                with self.lock:
+                    self.ser = ser
+                    self.port = port
+                    self.parse_errors = 0
+                    for info in list_ports.comports():
+                        if info.device == port and info.vid is not None:
+                            self.adapter = self.port_id(info)
+                print('evap: Serial port to EVC open ({})'.format(port))
+            else:
+                ser.close()
+        return self.connected
+
+    def disconnect(self, err_msg):
+        '''Closes the broken serial port and starts reconnecting.'''
+        print('Lost connection to EVC: {}'.format(err_msg))
+        with self.lock:
+            if self.ser is not None:
+                try:
+                    self.ser.close()
+                except SERIAL_ERRORS:
+                    pass
+            self.ser = None
+        self.reconnect()
+
+    def rescan(self):
+        '''Searches the EVC300 on all candidate ports (in the background).'''
+        if not self.connected:
+            self.full_scan = True
+            self.reconnect()
+
+    def reconnect(self):
+        '''Starts a background thread which rediscovers the EVC300 with
+        increasing delay between the attempts.'''
+        with self.lock:
+            if self.connected or (self.reconnect_thread is not None and
+                                  self.reconnect_thread.is_alive()):
+                return
+            self.reconnect_thread = threading.Thread(target=self.__run_reconnect)
+            self.reconnect_thread.daemon = True
+            self.reconnect_thread.start()
+
+    def __run_reconnect(self):
+        delay = self.backoff_min
+        while True:
+            full, self.full_scan = self.full_scan, False
+            if self.discover(full):
+                return
+            time.sleep(delay)
+            delay = min(2*delay, self.backoff_max)
 
     def get_value(self, str_val):
-        '''Reads value of parameter given by str_val. Returns float number.'''
-        self.ser.write('GET ' + str_val + '\r\n')
-        num = ''
-        time.sleep(0.01)
-        num = float(self.ser.read(self.ser.inWaiting()))
-        return num
+        '''Reads value of parameter given by str_val. Returns float number
+        or None if the EVC is not connected.'''
+        with self.lock:
+            if self.ser is None:
+                return None
+            try:
+                self.ser.flushInput()
+                self.ser.write('GET ' + str_val + '\r\n')
+                time.sleep(0.01)
+                reply = self.ser.read(self.ser.inWaiting())
+            except SERIAL_ERRORS as err_msg:
+                self.disconnect(err_msg)
+                return None
+            try:
+                val = float(reply)
+            except ValueError:
+                # slow or garbled reply, the sample is missing
+                self.parse_errors += 1
+                if self.parse_errors >= self.max_parse_errors:
+                    self.disconnect('{} invalid replies'.format(
+                        self.parse_errors))
+                return None
+            self.parse_errors = 0
+            return val
 
     def set_val(self, str_val, new_val, old_val, maxdiff):
         '''Writes new value EVC. maxdiff gives the maximal allowed difference.'''
+        if old_val is None:
+            print('set_val Err: Current value unknown.')
+            return
         dval = new_val - old_val
         if dval > maxdiff:
             print('set_val Err: Value change of {0} larger than allowed.\
@@ -165,10 +380,18 @@ class EVC():
         if dval < 0:
             vsign = '-'
         ## TODO: Raise exception if command unknown, value invalid, etc.
-        self.ser.write('SET {0} {1}{2:3.1f}\r\n'.format(str_val, vsign, abs(dval)))
-        time.sleep(0.1)
-        if self.ser.inWaiting() > 0:
-            print(self.ser.read(self.ser.inWaiting()))
+        with self.lock:
+            if self.ser is None:
+                print('set_val Err: EVC not connected.')
+                return
+            try:
+                self.ser.write('SET {0} {1}{2:3.1f}\r\n'.format(
+                    str_val, vsign, abs(dval)))
+                time.sleep(0.1)
+                if self.ser.inWaiting() > 0:
+                    print(self.ser.read(self.ser.inWaiting()))
+            except SERIAL_ERRORS as err_msg:
+                self.disconnect(err_msg)
 
 
 
@@ -196,6 +419,117 @@ class Data():
         self.emis.append(yvalue2)
 
 
+class SampleBus():
+    '''Ring buffer in shared memory which lets other processes (plotter,
+    logger, analyzer) read the EvapParams samples without slowing down the
+    polling of the EVC. The acquisition process creates the bus and is the
+    only writer, readers attach with create=False. Every record holds time,
+    fil, emis, flux, hv and temp as doubles; unknown values are NaN.'''
+    fields = ('time', 'fil', 'emis', 'flux', 'hv', 'temp')
+    header = struct.Struct('<QQ')  # capacity, number of written records
+    # every slot starts with the index + 1 of its record, 0 while written
+    seq = struct.Struct('<Q')
+    record = struct.Struct('<6d')
+
+    def __init__(self, name='evap_samples', capacity=4096, create=True):
+        '''Creates or attaches to the shared memory file /dev/shm/name.
+        Creating fails with RuntimeError while another writer is alive.'''
+        self.path = os.path.join('/dev/shm', name)
+        self.slot_size = self.seq.size + self.record.size
+        self.lock_fd = None
+        if create:
+            # the writer holds the lock file until the bus is closed
+            self.lock_fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT,
+                                   0o644)
+            try:
+                fcntl.flock(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except EnvironmentError:
+                os.close(self.lock_fd)
+                raise RuntimeError('SampleBus {} is used by another writer'
+                                   .format(self.path))
+            # build the file under a temporary name and move it into place,
+            # readers of an old bus keep their own mapping
+            tmp_path = '{}.{}'.format(self.path, os.getpid())
+            size = self.header.size + capacity*self.slot_size
+            fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+            os.ftruncate(fd, size)
+            self.buf = mmap.mmap(fd, size)
+            self.header.pack_into(self.buf, 0, capacity, 0)
+            os.rename(tmp_path, self.path)
+        else:
+            fd = os.open(self.path, os.O_RDONLY)
+            size = os.fstat(fd).st_size
+            if size < self.header.size:
+                os.close(fd)
+                raise ValueError('SampleBus {} is incomplete'.format(self.path))
+            self.buf = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+        self.inode = os.fstat(fd).st_ino
+        os.close(fd)
+        self.capacity = self.header.unpack_from(self.buf, 0)[0]
+        if (self.capacity == 0 or
+                size < self.header.size + self.capacity*self.slot_size):
+            self.buf.close()
+            raise ValueError('SampleBus {} is invalid'.format(self.path))
+
+    @property
+    def count(self):
+        '''Number of records written since the bus was created.'''
+        return self.header.unpack_from(self.buf, 0)[1]
+
+    @property
+    def replaced(self):
+        '''True if the file of the bus was removed or replaced by a new
+        writer. Readers have to attach again then.'''
+        try:
+            return os.stat(self.path).st_ino != self.inode
+        except OSError:
+            return True
+
+    def offset(self, index):
+        '''Returns the position of the slot of record index in the buffer.'''
+        return self.header.size + (index % self.capacity)*self.slot_size
+
+    def publish(self, evap, t=None):
+        '''Appends the current parameters of evap. The slot is marked
+        while the record is written, so readers never see it half done.'''
+        if t is None:
+            t = time.time()
+        vals = [getattr(evap, field, None) for field in self.fields[1:]]
+        vals = [float('nan') if val is None else val for val in vals]
+        count = self.count
+        offset = self.offset(count)
+        self.seq.pack_into(self.buf, offset, 0)
+        self.record.pack_into(self.buf, offset + self.seq.size, t, *vals)
+        self.seq.pack_into(self.buf, offset, count + 1)
+        self.header.pack_into(self.buf, 0, self.capacity, count + 1)
+
+    def read(self, start=0):
+        '''Returns the index of the next record and a list of the records
+        written since index start. Records overwritten in the meantime are
+        skipped.'''
+        count = self.count
+        records = []
+        for ii in range(max(start, count - self.capacity), count):
+            offset = self.offset(ii)
+            before = self.seq.unpack_from(self.buf, offset)[0]
+            record = self.record.unpack_from(self.buf, offset + self.seq.size)
+            # keep the record only if the slot still held it after reading
+            if before == ii + 1 == self.seq.unpack_from(self.buf, offset)[0]:
+                records.append(record)
+        return count, records
+
+    def close(self, unlink=False):
+        '''Detaches from the bus. The writer removes the file with
+        unlink=True.'''
+        self.buf.close()
+        if self.lock_fd is None:
+            return
+        if unlink and not self.replaced:
+            os.remove(self.path)
+        os.close(self.lock_fd)
+        self.lock_fd = None
+
+
 class DriveVal():
     '''DriveVal raises or lowers a value within a given duration by a
     function. Valstep is the delta which is used to raise by every time